@@ -5,8 +5,10 @@ https://arxiv.org/abs/1610.02242
 """
 
 import argparse
+import contextlib
+import inspect
 from argparse import Namespace
-from typing import Dict
+from typing import Dict, Tuple
 
 import numpy as np
 import torch
@@ -20,6 +22,7 @@ from torchvision.datasets import CIFAR10
 from torchvision.models import vgg11
 
 from baal.active import ActiveLearningDataset
+from baal.utils.ssl_iterator import JointBatchIterator
 from baal.utils.ssl_module import SSLModule
 
 import torch.multiprocessing
@@ -27,55 +30,60 @@ import torch.multiprocessing
 torch.multiprocessing.set_sharing_strategy('file_system')
 
 
-class GaussianNoise(nn.Module):
-    """ Add random gaussian noise to images."""
+def gaussian_noise(x, std=0.05):
+    """Add random gaussian noise to images."""
+    return x + torch.randn_like(x) * std
 
-    def __init__(self, std=0.05):
-        super(GaussianNoise, self).__init__()
-        self.std = std
-
-    def forward(self, x):
-        return x + torch.randn(x.size()).type_as(x) * self.std
 
+def random_horizontal_flip(x, p=0.5):
+    """Randomly flip a batch of images horizontally, on the images' device."""
+    flip = torch.rand(len(x), 1, 1, 1, device=x.device) < p
+    return torch.where(flip, x.flip(-1), x)
 
-class RandomTranslation(nn.Module):
-    """Randomly translate images."""
 
-    def __init__(self, augment_translation=10):
-        super(RandomTranslation, self).__init__()
-        self.augment_translation = augment_translation
+def _identity_grid(x, cache):
+    """Identity sampling coordinates for `x`, cached by shape, device and dtype."""
+    height, width = x.shape[-2:]
+    key = (height, width, x.device, x.dtype)
+    if key not in cache:
+        # Pixel centers, as `affine_grid` computes them with `align_corners=False`.
+        lin_h = torch.linspace(-1, 1, height, device=x.device, dtype=x.dtype)
+        lin_w = torch.linspace(-1, 1, width, device=x.device, dtype=x.dtype)
+        cache[key] = (lin_h[None, :, None] * (height - 1) / height,
+                      lin_w[None, None, :] * (width - 1) / width)
+    return cache[key]
 
-    def forward(self, x):
-        """
-            Randomly translate images.
-        Args:
-            x (Tensor) : (N, C, H, W) image tensor
 
-        Returns:
-            (N, C, H, W) translated image tensor
-        """
-        batch_size = len(x)
+def random_translation(x, augment_translation=10, cache=None):
+    """
+        Randomly translate images.
+    Args:
+        x (Tensor) : (N, C, H, W) image tensor
+        augment_translation (int) : maximum translation in pixels
+        cache (Optional[dict]) : cache for the identity grids, reused between calls
 
-        t_min = -self.augment_translation / x.shape[-1]
-        t_max = (self.augment_translation + 1) / x.shape[-1]
+    Returns:
+        (N, C, H, W) translated image tensor
+    """
+    batch_size = len(x)
 
-        matrix = torch.eye(3)[None].repeat((batch_size, 1, 1))
-        tx = (t_min - t_max) * torch.rand(batch_size) + t_max
-        ty = (t_min - t_max) * torch.rand(batch_size) + t_max
+    t_min = -augment_translation / x.shape[-1]
+    t_max = (augment_translation + 1) / x.shape[-1]
 
-        matrix[:, 0, 2] = tx
-        matrix[:, 1, 2] = ty
-        matrix = matrix[:, 0:2, :]
+    tx = torch.empty(batch_size, 1, 1, device=x.device, dtype=x.dtype).uniform_(t_min, t_max)
+    ty = torch.empty(batch_size, 1, 1, device=x.device, dtype=x.dtype).uniform_(t_min, t_max)
 
-        grid = nn.functional.affine_grid(matrix, x.shape).type_as(x)
-        x = nn.functional.grid_sample(x, grid)
+    # Only the translation changes, so the grid is the identity grid shifted by (tx, ty).
+    lin_h, lin_w = _identity_grid(x, {} if cache is None else cache)
+    grid = torch.stack(torch.broadcast_tensors(lin_w + tx, lin_h + ty), dim=-1)
+    x = nn.functional.grid_sample(x, grid, align_corners=False)
 
-        return x
+    return x
 
 
 class PIModel(SSLModule):
-    train_transform = transforms.Compose([transforms.RandomHorizontalFlip(),
-                                          transforms.RandomRotation(30),
+    # Horizontal flips of labeled batches are done on device in the training steps.
+    train_transform = transforms.Compose([transforms.RandomRotation(30),
                                           transforms.ToTensor(),
                                           transforms.Normalize(3 * [0.5], 3 * [0.5])])
     test_transform = transforms.Compose([transforms.ToTensor(),
@@ -85,54 +93,122 @@ class PIModel(SSLModule):
                  network: nn.Module):
         super().__init__(active_dataset, hparams)
 
-        self.network = network
+        # VGG is convolution heavy, NHWC matches the cuDNN Tensor Core layouts.
+        self.network = network.to(memory_format=torch.channels_last)
+        if self.hparams.compile_network:
+            if not hasattr(torch, 'compile'):
+                raise ValueError("--compile_network requires torch>=2.0")
+            self.network = torch.compile(self.network, mode='max-autotune')
+        if self.hparams.bf16 and not hasattr(torch, 'autocast'):
+            raise ValueError("--bf16 requires torch>=1.10")
 
         # Maximum unsupervised loss weight as defined in the paper.
         M = len(self.active_dataset)
         N = (len(self.active_dataset) + len(self.active_dataset.pool))
         self.max_unsupervised_weight = self.hparams.w_max * M / N
 
-        self.criterion = nn.CrossEntropyLoss()
-        self.consistency_criterion = nn.MSELoss()
-
         if self.hparams.baseline:
             assert self.hparams.p == 1, "Only labeled data is used for baseline (p=1)"
 
-        # Consistency augmentations
-        self.gaussian_noise = GaussianNoise()
-        self.random_crop = RandomTranslation()
+        # Consistency augmentations, applied as plain functions in `_augment`.
+        self._noise_std = 0.05
+        self._aug_t = 10
+        self._grid_cache = {}
+        if self.hparams.compile_augmentations:
+            if not hasattr(torch, 'compile'):
+                raise ValueError("--compile_augmentations requires torch>=2.0")
+            # Fuse translation and noise into a single kernel, shapes are static.
+            self._augment = torch.compile(self._augment, mode='max-autotune', dynamic=False)
+
+        # Set in `train_dataloader`.
+        self._joint_batches = False
 
         # Keep track of current lr for logging
         self.current_lr = self.hparams.lr
 
-    def forward(self, x):
+        # Ramp values only depend on the epoch, precompute the whole schedules.
+        rampup_stop = self.hparams.rampup_stop
+        if rampup_stop > 1:
+            # Ends at exp(0) = 1, lookups past the end are clamped to it.
+            self._rampup_table = np.exp(-5 * (1 - np.linspace(0, 1, rampup_stop)) ** 2)
+        else:
+            # No ramp-up.
+            self._rampup_table = np.ones(1)
+        rampdown_start = self.hparams.epochs - rampup_stop - 1
+        epochs = np.arange(self.hparams.epochs)
+        self._rampdown_table = np.where(epochs >= rampdown_start,
+                                        np.exp(-12.5 * (epochs / max(rampdown_start, 1)) ** 2), 0)
+        self._unsupervised_weight = float(self.max_unsupervised_weight * self.rampup_value())
+
+    def _autocast(self):
+        if self.hparams.bf16:
+            return torch.autocast('cuda', dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def _augment(self, x):
+        x = x.contiguous(memory_format=torch.channels_last)
         if self.training and not self.hparams.no_augmentations:
-            x = self.random_crop(x)
-            x = self.gaussian_noise(x)
+            x = random_translation(x, self._aug_t, self._grid_cache)
+            x = gaussian_noise(x, self._noise_std)
 
-        return self.network(x)
+        return x
 
-    def supervised_training_step(self, batch, *args) -> Dict:
-        x, y = batch
+    def forward(self, x):
+        return self.network(self._augment(x))
+
+    def _consistency_forward(self, x):
+        """
+            Compute the predictions for two stochastic augmentations of `x`.
+        Args:
+            x (Tensor) : (N, C, H, W) image tensor
 
+        Returns:
+            z, z_hat: (N, num_classes) logits, z_hat is computed without grad to be used as target.
+        """
         z = self.forward(x)
+        # The target needs no activations nor backward pass.
+        with torch.no_grad():
+            z_hat = self.forward(x)
+        return z, z_hat
 
-        supervised_loss = self.criterion(z, y)
+    @staticmethod
+    def consistency_loss(p, p_hat):
+        """
+            Squared difference between the predicted class probabilities, as in the paper.
+        Args:
+            p (Tensor) : (N, num_classes) class probabilities
+            p_hat (Tensor) : (N, num_classes) target class probabilities, already detached
 
-        accuracy = (y == z.argmax(-1)).float().sum() / len(x)
+        Returns:
+            Mean squared error between p and p_hat.
+        """
+        return (p - p_hat).pow(2).mean()
 
-        logs = {'criterion_loss': supervised_loss, 'accuracy': accuracy}
+    def _supervised_loss(self, z, y, z_hat=None) -> Tuple[Tensor, Dict]:
+        """
+            Supervised loss, with the weighted consistency loss when a target is given.
+        Args:
+            z (Tensor) : (N, num_classes) logits
+            y (Tensor) : (N,) labels
+            z_hat (Optional[Tensor]) : (N, num_classes) target logits, computed without grad
 
-        if not self.hparams.baseline:
-            with torch.no_grad():
-                z_hat = self.forward(x)
+        Returns:
+            loss and logs
+        """
+        # Share the log-softmax between the cross-entropy and the consistency loss.
+        log_p = nn.functional.log_softmax(z, -1)
+        supervised_loss = nn.functional.nll_loss(log_p, y)
+
+        accuracy = (y == z.argmax(-1)).float().mean()
+
+        logs = {'criterion_loss': supervised_loss, 'accuracy': accuracy}
 
-            unsupervised_loss = self.consistency_criterion(z, z_hat)
-            unsupervised_weight = self.max_unsupervised_weight * self.rampup_value()
-            loss = supervised_loss + unsupervised_weight * unsupervised_loss
+        if z_hat is not None:
+            unsupervised_loss = self.consistency_loss(log_p.exp(), nn.functional.softmax(z_hat, -1))
+            loss = supervised_loss + self._unsupervised_weight * unsupervised_loss
 
             logs.update({'supervised_consistency_loss': unsupervised_loss,
-                         'unsupervised_weight': unsupervised_weight})
+                         'unsupervised_weight': self._unsupervised_weight})
 
         else:
             loss = supervised_loss
@@ -142,48 +218,123 @@ class PIModel(SSLModule):
                      'learning_rate': self.current_lr
                      })
 
+        return loss, logs
+
+    def _unsupervised_loss(self, z, z_hat) -> Tuple[Tensor, Dict]:
+        """
+            Weighted consistency loss.
+        Args:
+            z (Tensor) : (N, num_classes) logits
+            z_hat (Tensor) : (N, num_classes) target logits, computed without grad
+
+        Returns:
+            loss and logs
+        """
+        unsupervised_loss = self.consistency_loss(nn.functional.softmax(z, -1),
+                                                  nn.functional.softmax(z_hat, -1))
+        loss = self._unsupervised_weight * unsupervised_loss
+
+        logs = {'unsupervised_consistency_loss': unsupervised_loss,
+                'unsupervised_loss': loss}
+
+        return loss, logs
+
+    def supervised_training_step(self, batch, *args) -> Dict:
+        x, y = batch
+        # Once per batch, before `_augment`, so that both consistency branches see the same flip.
+        x = random_horizontal_flip(x)
+
+        if not self.hparams.baseline:
+            z, z_hat = self._consistency_forward(x)
+        else:
+            z, z_hat = self.forward(x), None
+
+        loss, logs = self._supervised_loss(z, y, z_hat)
+
         return {'loss': loss, 'log': logs}
 
     def unsupervised_training_step(self, batch, *args) -> Dict:
         x, _ = batch
 
-        with torch.no_grad():
-            z = self.forward(x)
-        z_hat = self.forward(x)
+        z, z_hat = self._consistency_forward(x)
 
-        unsupervised_loss = self.consistency_criterion(z, z_hat)
-        unsupervised_weight = self.max_unsupervised_weight * self.rampup_value()
-        loss = unsupervised_weight * unsupervised_loss
-
-        logs = {'unsupervised_consistency_loss': unsupervised_loss,
-                'unsupervised_loss': loss}
+        loss, logs = self._unsupervised_loss(z, z_hat)
 
         return {'loss': loss, 'log': logs}
 
+    def joint_training_step(self, batch, *args) -> Dict:
+        """
+            Labeled and unlabeled training step, with the forward passes of both batches batched.
+        Args:
+            batch: pair of labeled (x, y) and unlabeled (x, _) batches
+
+        Returns:
+            Dict with the loss and logs.
+        """
+        (x_l, y), (x_u, _) = batch
+        x_l = random_horizontal_flip(x_l)
+        sizes = [len(x_l), len(x_u)]
+
+        z, z_hat = self._consistency_forward(torch.cat([x_l, x_u], dim=0))
+        (z_l, z_u), (z_l_hat, z_u_hat) = z.split(sizes, dim=0), z_hat.split(sizes, dim=0)
+
+        supervised_loss, logs = self._supervised_loss(z_l, y, z_l_hat)
+        unsupervised_loss, unsupervised_logs = self._unsupervised_loss(z_u, z_u_hat)
+        logs.update(unsupervised_logs)
+
+        return {'loss': supervised_loss + unsupervised_loss, 'log': logs}
+
+    def training_step(self, batch, *args):
+        with self._autocast():
+            if self._joint_batches:
+                return self.joint_training_step(batch, *args)
+            return super().training_step(batch, *args)
+
+    def train_dataloader(self):
+        # Decided once per dataloader, the pool only changes between fits.
+        self._joint_batches = (self.hparams.joint_batches and not self.hparams.baseline
+                               and self.active_dataset.n_unlabelled > 0)
+        if not self._joint_batches:
+            return super().train_dataloader()
+
+        if self.hparams.p is not None:
+            raise ValueError("--p selects alternating batches, it can't be used with"
+                             " --joint_batches")
+
+        labeled_dl = DataLoader(self.active_dataset, self.hparams.batch_size, shuffle=True,
+                                num_workers=self.hparams.workers)
+        unlabeled_dl = DataLoader(self.active_dataset.pool, self.hparams.batch_size, shuffle=True,
+                                  num_workers=self.hparams.workers)
+        return JointBatchIterator(labeled_dl, unlabeled_dl, num_steps=self.hparams.num_steps)
+
+    def on_epoch_start(self):
+        # Python float so that the loss weighting stays a scalar multiplication.
+        self._unsupervised_weight = float(self.max_unsupervised_weight * self.rampup_value())
+
     def rampup_value(self):
-        if self.current_epoch <= self.hparams.rampup_stop - 1:
-            T = (1 / (self.hparams.rampup_stop - 1)) * self.current_epoch
-            return np.exp(-5 * (1 - T) ** 2)
-        else:
-            return 1
+        return float(self._rampup_table[min(self.current_epoch, len(self._rampup_table) - 1)])
 
     def rampdown_value(self):
-        if self.current_epoch >= self.epoch - self.hparams.rampup_stop - 1:
-            T = (1 / (self.epoch - self.hparams.rampup_stop - 1)) * self.current_epoch
-            return np.exp(-12.5 * T ** 2)
-        else:
-            return 0
+        return float(self._rampdown_table[min(self.current_epoch, len(self._rampdown_table) - 1)])
+
+    @staticmethod
+    def _optimizer_kwargs():
+        # Multi-tensor implementation: one kernel per group of parameters instead of per parameter.
+        if 'foreach' in inspect.signature(torch.optim.SGD).parameters:
+            return {'foreach': True}
+        return {}
 
     def configure_optimizers(self):
         return torch.optim.SGD(self.parameters(), lr=self.hparams.lr, momentum=0.9,
-                               weight_decay=1e-4)
+                               weight_decay=1e-4, **self._optimizer_kwargs())
 
     def test_val_step(self, batch: int, prefix: str) -> Dict[str, Tensor]:
         x, y = batch
-        y_hat = self(x)
+        with self._autocast():
+            y_hat = self(x)
+            loss_val = nn.functional.cross_entropy(y_hat, y)
 
-        loss_val = self.criterion(y_hat, y)
-        accuracy = (y == y_hat.argmax(-1)).float().sum() / len(x)
+        accuracy = (y == y_hat.argmax(-1)).float().mean()
 
         output = {'{}_loss'.format(prefix): loss_val, '{}_accuracy'.format(prefix): accuracy}
 
@@ -195,21 +346,28 @@ class PIModel(SSLModule):
     def test_step(self, batch, batch_idx) -> Dict[str, Tensor]:
         return self.test_val_step(batch, prefix='test')
 
-    def val_dataloader(self):
+    def _eval_dataloader(self):
         ds = CIFAR10(root=self.hparams.data_root, train=False, transform=self.test_transform,
                      download=True)
-        return DataLoader(ds, self.hparams.batch_size, shuffle=False, num_workers=self.hparams.workers)
+        # Keep workers alive between evaluations and pin memory for async host to GPU copies.
+        worker_kwargs = {}
+        if (self.hparams.workers > 0
+                and 'persistent_workers' in inspect.signature(DataLoader).parameters):
+            worker_kwargs = {'persistent_workers': True, 'prefetch_factor': 2}
+        return DataLoader(ds, self.hparams.batch_size, shuffle=False,
+                          num_workers=self.hparams.workers,
+                          pin_memory=torch.cuda.is_available(), **worker_kwargs)
+
+    def val_dataloader(self):
+        return self._eval_dataloader()
 
     def test_dataloader(self):
-        ds = CIFAR10(root=self.hparams.data_root, train=False, transform=self.test_transform,
-                     download=True)
-        return DataLoader(ds, self.hparams.batch_size, shuffle=False, num_workers=self.hparams.workers)
+        return self._eval_dataloader()
 
     def epoch_end(self, outputs):
-        avg_metrics = {}
-        for key in outputs[0].keys():
-            if isinstance(outputs[0][key], torch.Tensor):
-                avg_metrics[key] = torch.stack([x[key] for x in outputs]).mean()
+        keys = [key for key, value in outputs[0].items() if isinstance(value, torch.Tensor)]
+        stacked = {key: torch.stack([x[key] for x in outputs]) for key in keys}
+        avg_metrics = {key: value.mean() for key, value in stacked.items()}
 
         output = {}
         output['progress_bar'] = avg_metrics
@@ -237,7 +395,7 @@ class PIModel(SSLModule):
         """
         parser = super(PIModel, PIModel).add_model_specific_args(parent_parser)
         parser.add_argument('--baseline', action='store_true')
-        parser.add_argument('--rampup_stop', default=80)
+        parser.add_argument('--rampup_stop', default=80, type=int)
         parser.add_argument('--epochs', default=300, type=int)
         parser.add_argument('--batch-size', default=100, type=int, help='batch size')
         parser.add_argument('--lr', default=0.003, type=float, help='Max learning rate', dest='lr')
@@ -245,6 +403,16 @@ class PIModel(SSLModule):
                             help='Maximum unsupervised weight, default=100 for CIFAR10 as '
                                  'described in paper')
         parser.add_argument('--no_augmentations', action='store_true')
+        parser.add_argument('--compile_augmentations', action='store_true',
+                            help='Compile the augmentations with torch.compile (torch>=2.0)')
+        parser.add_argument('--compile_network', action='store_true',
+                            help='Compile the network with torch.compile (torch>=2.0)')
+        parser.add_argument('--joint_batches', action='store_true',
+                            help='Train on a labeled and an unlabeled batch per step, batching '
+                                 'their forward passes. --num_steps defaults to one pass over '
+                                 'the labeled data, --p is not supported')
+        parser.add_argument('--bf16', action='store_true',
+                            help='Run forward passes under bfloat16 autocast on CUDA')
         return parser
 
 
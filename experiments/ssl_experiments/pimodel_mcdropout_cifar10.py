@@ -27,7 +27,8 @@ class PIActiveLearningModel(ActiveLearningMixin, PIModel):
                           num_workers=4)
 
     def configure_optimizers(self):
-        return torch.optim.SGD(self.parameters(), lr=self.hparams.lr, weight_decay=1e-4)
+        return torch.optim.SGD(self.parameters(), lr=self.hparams.lr, weight_decay=1e-4,
+                               **self._optimizer_kwargs())
 
     def optimizer_step(self, epoch_nb, batch_nb, optimizer, optimizer_i, opt_closure, **kwargs):
         optimizer.step()
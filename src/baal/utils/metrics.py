@@ -313,7 +313,8 @@ class Accuracy(Metrics):
         self.maxk = max(topk)
 
     def reset(self):
-        self.accuracy = torch.FloatTensor()
+        # One row of top-k accuracies per update, stacked in `calculate_result`.
+        self.accuracy = []
 
     def update(self, output=None, target=None):
         """
@@ -342,15 +343,10 @@ class Accuracy(Metrics):
             correct_k = correct[:, :k].contiguous().view(-1).float().sum()
             topk_acc.append(float(correct_k.mul_(1.0 / batch_size)))
 
-        if len(self.accuracy) == 0:
-            self.accuracy = torch.FloatTensor(topk_acc).unsqueeze(0)
-        else:
-            self.accuracy = torch.cat(
-                [self.accuracy, torch.FloatTensor(topk_acc).unsqueeze(0)], dim=0
-            )
+        self.accuracy.append(topk_acc)
 
     def calculate_result(self) -> torch.Tensor:
-        return self.accuracy
+        return torch.FloatTensor(self.accuracy)
 
 
 class Precision(Metrics):
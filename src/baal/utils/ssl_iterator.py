@@ -65,6 +65,43 @@ class AlternateIterator:
         return item, idx
 
 
+class JointBatchIterator:
+    """
+    Create an iterator that returns a pair of labeled and unlabeled batches at each step.
+
+    Args:
+        labeled_dl (DataLoader): labeled DataLoader, restarted whenever it is exhausted.
+        unlabeled_dl (DataLoader): unlabeled DataLoader, restarted whenever it is exhausted.
+        num_steps (Optional[int]): Number of steps, if None will be the length of labeled_dl.
+            If either DataLoader is empty, there are no steps.
+    """
+
+    def __init__(self, labeled_dl: DataLoader, unlabeled_dl: DataLoader,
+                 num_steps: Optional[int] = None):
+        self.labeled_dl = labeled_dl
+        self.unlabeled_dl = unlabeled_dl
+        if len(labeled_dl) == 0 or len(unlabeled_dl) == 0:
+            num_steps = 0
+        self.num_steps = len(labeled_dl) if num_steps is None else num_steps
+
+    @staticmethod
+    def _cycle(dl: DataLoader):
+        # Unlike itertools.cycle, re-iterate the DataLoader so that batches are not kept around.
+        if len(dl) == 0:
+            return
+        while True:
+            yield from dl
+
+    def __len__(self):
+        return self.num_steps
+
+    def __iter__(self):
+        labeled_iter = self._cycle(self.labeled_dl)
+        unlabeled_iter = self._cycle(self.unlabeled_dl)
+        for _ in range(self.num_steps):
+            yield next(labeled_iter), next(unlabeled_iter)
+
+
 class SemiSupervisedIterator(AlternateIterator):
     """
         Iterator for alternating between labeled and un-labled dataloaders
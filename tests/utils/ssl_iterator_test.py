@@ -1,11 +1,12 @@
 import unittest
 
+import numpy as np
 import pytest
 import torch
-from torch.utils.data import Dataset, ConcatDataset
+from torch.utils.data import Dataset, ConcatDataset, DataLoader
 
 from baal.active import ActiveLearningDataset
-from baal.utils.ssl_iterator import SemiSupervisedIterator
+from baal.utils.ssl_iterator import SemiSupervisedIterator, JointBatchIterator
 
 
 class SSLTestDataset(Dataset):
@@ -14,12 +15,12 @@ class SSLTestDataset(Dataset):
 
     def __init__(self, labeled=True, length=100):
         if labeled:
-            self.data = torch.tensor(range(0, length * 2, 2))
+            self.data = np.arange(0, length * 2, 2, dtype=np.int64)
         else:
-            self.data = torch.tensor(range(1, length * 2, 2))
+            self.data = np.arange(1, length * 2, 2, dtype=np.int64)
 
     def __getitem__(self, index):
-        return self.data[index]
+        return int(self.data[index])
 
     def __len__(self):
         return len(self.data)
@@ -102,5 +103,40 @@ class SSLDatasetTest(unittest.TestCase):
         assert u_ratio == 0
 
 
+class JointBatchIteratorTest(unittest.TestCase):
+    def setUp(self):
+        self.labeled_dl = DataLoader(SSLTestDataset(labeled=True, length=100), batch_size=10)
+        self.unlabeled_dl = DataLoader(SSLTestDataset(labeled=False, length=1000), batch_size=10)
+
+    def test_pairs(self):
+        iterator = JointBatchIterator(self.labeled_dl, self.unlabeled_dl)
+        for labeled_batch, unlabeled_batch in iterator:
+            assert torch.all(labeled_batch % 2 == 0)
+            assert torch.all(unlabeled_batch % 2 != 0)
+
+    def test_default_len(self):
+        iterator = JointBatchIterator(self.labeled_dl, self.unlabeled_dl)
+        assert len(iterator) == len(self.labeled_dl)
+        assert len(list(iterator)) == len(self.labeled_dl)
+
+    def test_num_steps(self):
+        # More steps than labeled batches, the labeled DataLoader is restarted.
+        iterator = JointBatchIterator(self.labeled_dl, self.unlabeled_dl, num_steps=25)
+        batches = list(iterator)
+        assert len(iterator) == len(batches) == 25
+
+        labeled_data = torch.cat([labeled_batch for labeled_batch, _ in batches])
+        unlabeled_data = torch.cat([unlabeled_batch for _, unlabeled_batch in batches])
+        assert torch.all(labeled_data % 2 == 0)
+        assert len(labeled_data.unique()) == 100
+        assert len(unlabeled_data.unique()) == 250
+
+    def test_empty_labeled(self):
+        empty_dl = DataLoader(SSLTestDataset(labeled=True, length=0), batch_size=10)
+        iterator = JointBatchIterator(empty_dl, self.unlabeled_dl, num_steps=10)
+        assert len(iterator) == 0
+        assert list(iterator) == []
+
+
 if __name__ == '__main__':
     pytest.main()